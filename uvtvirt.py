@@ -15,52 +15,240 @@
 """
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 import os
 import logging
-import lsb_release
-import requests
+import re
+import secrets
+import selectors
 import shlex
+import shutil
 from subprocess import (
     Popen,
     PIPE,
     DEVNULL,
-    CalledProcessError,
-    check_output,
-    call
+    CalledProcessError
 )
 import sys
-import tempfile
-import tarfile
-import time
-import apt
-import urllib.request
+import threading
 from urllib.parse import urlparse
 from uuid import uuid4
 
 DEFAULT_TIMEOUT = 500
 
 
+@lru_cache(maxsize=1)
+def _os_release():
+    """
+    Key/value pairs from /etc/os-release, read once per process.  This
+    gives the same release information as lsb_release without having
+    to import it.  As the os-release spec says, /usr/lib/os-release is
+    read if /etc/os-release doesn't exist.
+    """
+    try:
+        f = open("/etc/os-release")
+    except FileNotFoundError:
+        f = open("/usr/lib/os-release")
+    with f:
+        data = dict(line.rstrip().split("=", 1) for line in f if "=" in line)
+    return {key: value.strip('"') for key, value in data.items()}
+
+
+@lru_cache(maxsize=1)
+def _arch():
+    """Host dpkg architecture, looked up once per process."""
+    return spawn_output(['dpkg', '--print-architecture']).strip()
+
+
+def spawn(argv, **kwargs):
+    """
+    Popen wrapper that lets subprocess take its posix_spawn() fast path
+    (vfork+exec) instead of fork()ing the whole interpreter.  That path
+    is only used when the executable has a directory component and
+    close_fds is False; the pipes subprocess creates are
+    non-inheritable, so no descriptors leak into the child.
+    """
+    executable = shutil.which(argv[0]) or argv[0]
+    return Popen(argv, executable=executable, close_fds=False, **kwargs)
+
+
+def spawn_output(argv, **kwargs):
+    """
+    check_output() equivalent built on spawn().  Returns stdout as text
+    and raises CalledProcessError if the command fails.
+    """
+    proc = spawn(argv, stdout=PIPE, stdin=DEVNULL, universal_newlines=True,
+                 **kwargs)
+    output, _ = proc.communicate()
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, argv, output)
+    return output
+
+
+class ShellSession(object):
+    """
+    A long-lived bash coprocess that commands are fed to over stdin.
+
+    Reusing one shell avoids a fork+exec of the interpreter for every
+    command.  After each command a sentinel is printed on stdout (with
+    the return code) and on stderr, so the output of each command can be
+    split out of the streams.
+    """
+
+    def __init__(self):
+        self.proc = spawn(['/bin/bash'], stdin=PIPE, stdout=PIPE,
+                          stderr=PIPE, bufsize=0)
+        # Held while a command is running; the shell runs one at a time
+        self.lock = threading.Lock()
+
+    def run(self, cmd, capture_stdout=True):
+        """
+        Run the argv list cmd in the shell and return a
+        (stdout, stderr, returncode) tuple.  If capture_stdout is False
+        the command's stdout is sent to /dev/null and None is returned
+        for it.  Commands from other threads wait for the shell.
+        """
+        with self.lock:
+            return self._run(cmd, capture_stdout)
+
+    def _run(self, cmd, capture_stdout):
+        marker = uuid4().hex
+        redirect = "" if capture_stdout else " > /dev/null"
+        # The argv is quoted for the shell, so nothing in it is expanded
+        script = ("{{ {}\n}} < /dev/null{}; "
+                  "printf '\\0%s:%d\\0' {} \"$?\"; "
+                  "printf '\\0%s\\0' {} >&2\n".format(shlex.join(cmd),
+                                                      redirect, marker,
+                                                      marker))
+        out_end = re.compile(b'\0' + marker.encode() + rb':(\d+)\0\Z')
+        err_end = b'\0' + marker.encode() + b'\0'
+        # The sentinel is always the last thing written, so it is enough
+        # to look for it at the end of the buffer
+        out_tail = len(marker) + 24
+
+        self.proc.stdin.write(script.encode())
+
+        out = bytearray()
+        err = bytearray()
+        returncode = None
+        sel = selectors.DefaultSelector()
+        sel.register(self.proc.stdout, selectors.EVENT_READ, out)
+        sel.register(self.proc.stderr, selectors.EVENT_READ, err)
+        while sel.get_map():
+            for key, _ in sel.select():
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    # The shell went away before printing the sentinel
+                    sel.unregister(key.fileobj)
+                    continue
+                key.data.extend(chunk)
+                if key.data is out:
+                    match = out_end.search(out, max(len(out) - out_tail, 0))
+                    if match:
+                        returncode = int(match.group(1))
+                        del out[match.start():]
+                        sel.unregister(key.fileobj)
+                elif err.endswith(err_end):
+                    del err[-len(err_end):]
+                    sel.unregister(key.fileobj)
+        sel.close()
+
+        if returncode is None:
+            returncode = self.proc.wait()
+        stdout = out.decode(errors='replace') if capture_stdout else None
+        return (stdout, err.decode(errors='replace'), returncode)
+
+    def alive(self):
+        """
+        False once the shell has exited, e.g. after a command ran exit or
+        the shell was killed.  Such a shell can't run further commands.
+        """
+        return self.proc.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+
+
+class ShellPool(object):
+    """
+    A set of ShellSessions shared between threads.  A command is run in
+    an idle shell, and a new shell is only started when all of them are
+    busy, so concurrent commands don't fall back to spawning a process
+    (and allocating pipes) each.  Shells that have exited are dropped.
+    """
+
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def run(self, cmd, capture_stdout=True):
+        """
+        Run cmd in an idle shell, see ShellSession.run().
+        """
+        shell = None
+        with self.lock:
+            while self.idle and shell is None:
+                shell = self.idle.pop()
+                if not shell.alive():
+                    shell.close()
+                    shell = None
+        if shell is None:
+            shell = ShellSession()
+        try:
+            return shell.run(cmd, capture_stdout)
+        finally:
+            if shell.alive():
+                with self.lock:
+                    self.idle.append(shell)
+            else:
+                shell.close()
+
+    def close(self):
+        with self.lock:
+            for shell in self.idle:
+                shell.close()
+            self.idle = []
+
+
 class RunCommand(object):
     """
-    Runs a command and can return all needed info:
+    Runs a command, given as an argv list, and can return all needed
+    info:
     * stdout
     * stderr
     * return code
     * original command
 
     Convenince class to avoid the same repetitive code to run shell
-    commands.
+    commands.  If a ShellSession or ShellPool is given the command is
+    run in it, otherwise a new process is spawned for the command.
+
+    With capture_stdout=False the command's stdout is discarded instead
+    of being buffered, and stdout is left as None.
     """
 
-    def __init__(self, cmd=None):
+    def __init__(self, cmd=None, shell=None, capture_stdout=True):
         self.stdout = None
         self.stderr = None
         self.returncode = None
         self.cmd = cmd
+        self.shell = shell
+        self.capture_stdout = capture_stdout
         self.run(self.cmd)
 
     def run(self, cmd):
-        proc = Popen(shlex.split(cmd), stdout=PIPE, stderr=PIPE,
+        if self.shell is not None:
+            self.stdout, self.stderr, self.returncode = \
+                self.shell.run(cmd, self.capture_stdout)
+            return
+
+        stdout = PIPE if self.capture_stdout else DEVNULL
+        proc = spawn(cmd, stdout=stdout, stderr=PIPE,
                      stdin=DEVNULL, universal_newlines=True)
         self.stdout, self.stderr = proc.communicate()
         self.returncode = proc.returncode
@@ -68,44 +256,93 @@ class RunCommand(object):
 
 class UVTKVMTest(object):
 
-    def __init__(self, image=None):
+    def __init__(self, image=None, persistent_shell=True):
         self.image = image
-        self.release = lsb_release.get_distro_information()["CODENAME"]
-        self.arch = check_output(['dpkg', '--print-architecture'],
-                                 universal_newlines=True).strip()
-        self.name = tempfile.mktemp()[5:]
+        self.release = _os_release()["VERSION_CODENAME"]
+        self.arch = _arch()
+        self.name = "uvt-" + secrets.token_hex(4)
+        # Commands are run in long-lived shells unless asked otherwise
+        self._shell = ShellPool() if persistent_shell else None
+
+        # The VM name doesn't change, so build these commands only once
+        run = self.run_command
+        self._destroy = partial(run, ['virsh', 'destroy', self.name])
+        self._undefine = partial(run, ['virsh', 'undefine', self.name])
+        self._purge = partial(run, ['uvt-simplestreams-libvirt', 'purge'])
+        self._wait = partial(run, ['uvt-kvm', 'wait', self.name])
+        self._list = partial(run, ['uvt-kvm', 'list'])
+        self._ssh_lsb = partial(run, ['uvt-kvm', 'ssh', self.name,
+                                      'lsb_release', '-sc'])
 
     def run_command(self, cmd):
-        task = RunCommand(cmd)
+        return self.run_task(cmd).returncode == 0
+
+    def run_task(self, cmd, capture_stdout=None):
+        """
+        Run cmd, log how it went and return the RunCommand.  stdout is
+        only kept if capture_stdout is True or debug logging is enabled.
+        """
+        if capture_stdout is None:
+            # stdout is only ever logged at debug level, so don't hold on
+            # to it otherwise.  stderr is always kept for reporting
+            # failures.
+            capture_stdout = logging.getLogger().isEnabledFor(logging.DEBUG)
+        task = RunCommand(cmd, self._shell, capture_stdout=capture_stdout)
         if task.returncode != 0:
             logging.error('Command {} returnd a code of {}'.format(
-                task.cmd, task.returncode))
-            logging.error(' STDOUT: {}'.format(task.stdout))
+                shlex.join(task.cmd), task.returncode))
+            if task.stdout is not None:
+                logging.error(' STDOUT: {}'.format(task.stdout))
             logging.error(' STDERR: {}'.format(task.stderr))
-            return False
         else:
-            logging.debug('Command {}:'.format(task.cmd))
-            if task.stdout != '':
+            logging.debug('Command {}:'.format(shlex.join(task.cmd)))
+            if task.stdout:
                 logging.debug(' STDOUT: {}'.format(task.stdout))
             elif task.stderr != '':
                 logging.debug(' STDERR: {}'.format(task.stderr))
             else:
                 logging.debug(' Command returned no output')
-            return True
+        return task
+
+    def check_packages(self, pkg_names):
+        """
+        Install any of pkg_names that are missing, loading the apt cache
+        once and committing all of the installs in one transaction.
 
-    def check_package(self, pkg_name):
+        dpkg-query is asked first so the apt cache is only loaded when
+        something actually needs to be installed.
+        """
+        cmd = ['dpkg-query', '-W', '-f=${Package} ${Status}\n'] + pkg_names
+        try:
+            output = spawn_output(cmd, stderr=DEVNULL)
+        except CalledProcessError as e:
+            # dpkg-query exits non-zero when a package is unknown to it
+            output = e.output
+        installed = set()
+        for line in output.splitlines():
+            pkg_name, _, status = line.partition(' ')
+            if status == "install ok installed":
+                installed.add(pkg_name)
+
+        missing = []
+        for pkg_name in pkg_names:
+            if pkg_name in installed:
+                print("{} already installed".format(pkg_name))
+            else:
+                missing.append(pkg_name)
+        if not missing:
+            return
+
+        import apt
         cache = apt.Cache()
 
-        pkg = cache[pkg_name]
-        if pkg.is_installed:
-            print("{} already installed".format(pkg_name))
-        else:
-            pkg.mark_install()
+        for pkg_name in missing:
+            cache[pkg_name].mark_install()
 
         try:
             cache.commit()
         except Exception:
-            print("Install of {} failed".format(sys.stderr))
+            print("Install of {} failed".format(", ".join(missing)))
 
     def get_image_or_source(self):
         """
@@ -119,13 +356,14 @@ class UVTKVMTest(object):
             logging.debug("Cloud image exists locally at %s" % url.path)
             self.image = url.path
         else:
-            cmd = ("uvt-simplestreams-libvirt sync release={} "
-                   "arch={}".format(self.release, self.arch))
+            cmd = ['uvt-simplestreams-libvirt', 'sync',
+                   'release={}'.format(self.release),
+                   'arch={}'.format(self.arch)]
 
             if url.scheme == 'http':
                 # Path specified to use -source option
                 logging.debug("Using --source option for uvt-simpletreams")
-                cmd = cmd + " --source {} ".format(self.image)
+                cmd += ['--source', self.image]
 
             logging.debug("uvt-simplestreams-libvirt sync")
             if not self.run_command(cmd):
@@ -139,59 +377,77 @@ class UVTKVMTest(object):
         is seen:
         https://bugs.launchpad.net/ubuntu/+source/uvtool/+bug/1452095
         """
-        # Destroy vm
-        logging.debug("Destroy VM")
-        if not self.run_command('virsh destroy {}'.format(self.name)):
-            return False
-
-        # Virsh undefine
-        logging.debug("Undefine VM")
-        if not self.run_command('virsh undefine {}'.format(self.name)):
-            return False
-
-        # Purge/Remove simplestreams image
-        if not self.run_command("uvt-simplestreams-libvirt purge"):
-            return False
-        return True
+        try:
+            # Destroy vm
+            logging.debug("Destroy VM")
+            if not self._destroy():
+                return False
 
-    def start(self):
-        # Generate ssh key if needed
+            # Undefining the vm and purging the simplestreams image touch
+            # separate state, so run them at the same time
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                # Purge/Remove simplestreams image
+                purged = executor.submit(self._purge)
+
+                # Virsh undefine
+                logging.debug("Undefine VM")
+                undefined = self._undefine()
+            return undefined and purged.result()
+        finally:
+            if self._shell is not None:
+                self._shell.close()
+                self._shell = None
+
+    def ensure_ssh_key(self):
+        """
+        Generate an ssh key for uvt-kvm to use if there isn't one yet.
+        """
         home_dir = os.environ['HOME']
         ssh_key_file = "{}/.ssh/id_rsa".format(home_dir)
 
         if not os.path.exists(ssh_key_file):
-            self.run_command("mkdir -p {}/.ssh".format(home_dir))
+            self.run_command(['mkdir', '-p', '{}/.ssh'.format(home_dir)])
 
-            cmd = ('ssh-keygen -f {} -t rsa -N \'\''.format(ssh_key_file))
+            cmd = ['ssh-keygen', '-f', ssh_key_file, '-t', 'rsa', '-N', '']
             if not self.run_command(cmd):
                 return False
+        return True
+
+    def start(self):
+        # Generate ssh key if needed
+        if not self.ensure_ssh_key():
+            return False
 
         # Create vm
         logging.debug("Creating VM")
-        cmd = ('uvt-kvm create {} arch={}'.format(self.name, self.arch))
+        cmd = ['uvt-kvm', 'create', self.name, 'arch={}'.format(self.arch)]
 
         if self.image.find(".img") > 0:
-            cmd = cmd + " --backing-image-file {} ".format(self.image)
+            cmd += ['--backing-image-file', self.image]
 
         if not self.run_command(cmd):
             return False
 
         logging.debug("Wait for VM to complete creation")
-        if not self.run_command('uvt-kvm wait {}'.format(self.name)):
+        if not self._wait():
             return False
 
         logging.debug("List newly created vm")
-        cmd = ("uvt-kvm list")
-        if not self.run_command(cmd):
+        if not self._list():
             return False
 
-        logging.debug("Verify VM was created with ssh")
-        if not self.run_command('uvt-kvm ssh {}'.format(self.name)):
+        logging.debug("Verify VM is running")
+        task = self.run_task(['virsh', 'domstate', self.name],
+                             capture_stdout=True)
+        if task.returncode != 0:
+            return False
+        if 'running' not in task.stdout:
+            logging.error('VM {} is not running, state: {}'.format(
+                self.name, task.stdout.strip()))
             return False
 
         logging.debug("Verify VM was created with ssh and run a command")
-        if not self.run_command('uvt-kvm ssh {} \"lsb_release -a \"'
-                                .format(self.name)):
+        if not self._ssh_lsb():
             return False
 
         return True
@@ -210,9 +466,14 @@ def test_uvtkvm(args):
         image = args.image
 
     uvt_test = UVTKVMTest(image)
-    uvt_test.check_package("uvtool")
-    uvt_test.check_package("uvtool-libvirt")
-    uvt_test.get_image_or_source()
+    uvt_test.check_packages(["uvtool", "uvtool-libvirt"])
+
+    # Syncing the image is bound by the network and does not depend on
+    # the ssh key, so generate the key while the sync runs.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        image_ready = executor.submit(uvt_test.get_image_or_source)
+        uvt_test.ensure_ssh_key()
+        image_ready.result()
     result = uvt_test.start()
     uvt_test.cleanup()
 
@@ -241,18 +502,7 @@ def main(args):
     except AttributeError:
         pass  # avoids exception when trying to run without specifying 'kvm'
 
-    # silence normal output from requests module
-    logging.getLogger("requests").setLevel(logging.WARNING)
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
-
-    # Verify args
-    try:
-        args.func(args)
-        print("in try block")
-
-    except AttributeError:
-        parser.print_help()
-        return 1
+    args.func(args)
 
     return 0
 